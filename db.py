@@ -7,12 +7,25 @@ databases db module
 """
 import time
 import threading
+import contextvars
 import logging
 import functools
+import itertools
+import keyword
+import queue
+import re
+import collections
 
 import pymysql
 
 engine = None
+_logger = logging.getLogger(__name__)
+
+# rows per statement for the bulk helpers, keeps packets below max_allowed_packet
+BULK_CHUNK_SIZE = 1000
+# rows fetched per round of a streaming select, and the upper bound callers may ask for
+DEFAULT_BULK_FETCH_ROW_COUNT = 5000
+MAX_BULK_FETCH_ROW_COUNT = 50000
 
 
 def create_engine(username, password, database, host, port, **kwargs):
@@ -23,54 +36,224 @@ def create_engine(username, password, database, host, port, **kwargs):
     :param database: database name
     :param host: host
     :param port: port
-    :param kwargs: other params
+    :param kwargs: other params, ``pool_min`` and ``pool_max`` set the pool size,
+        pooled connections idle longer than ``ping_threshold`` seconds (default
+        30, keep it below the server's wait_timeout) are pinged before reuse.
+        ``batch=True`` defers the auto commit of writes outside a transaction,
+        they are committed together by the first query that runs at least
+        ``batch_window_ms`` (default 5) after the first deferred write, by
+        ``flush()``, by a transaction or when the connection block exits.
+        there is no background timer, so a block that stops querying keeps
+        the writes uncommitted, and their row locks held, until one of those
+        happens. a crash before the commit loses the deferred writes, so only
+        enable it when that is acceptable.
+        ``driver`` picks the DB-API module, ``'pymysql'`` (default) or
+        ``'mysqlclient'`` which decodes rows in C.
+        ``compress=True`` turns on zlib protocol compression, it shrinks large
+        text results over slow links but costs CPU on small queries, and only
+        the mysqlclient driver supports it. ``net_timeout`` sets the session's
+        net_read_timeout and net_write_timeout in seconds when no
+        ``init_command`` is given. the server aborts a ``stream=True`` select
+        whose consumer pauses longer than net_write_timeout between fetches,
+        so keep it above the slowest consumer.
     :return: None
     """
     global engine
     if engine is not None:
         raise DBError("Engine is already initialized")
 
+    pool_min = kwargs.pop("pool_min", 5)
+    pool_max = kwargs.pop("pool_max", 32)
+    ping_threshold = kwargs.pop("ping_threshold", 30)
+    batch = kwargs.pop("batch", False)
+    batch_window_ms = kwargs.pop("batch_window_ms", 5)
+    driver = kwargs.pop("driver", "pymysql")
+    connect, cursors = _load_driver(driver)
+    compress = kwargs.pop("compress", False)
+    net_timeout = kwargs.pop("net_timeout", None)
+    if compress and driver == "pymysql":
+        raise DBError("Driver 'pymysql' doesn't support compress, use driver='mysqlclient'")
+
     params = dict(user=username,
                   passwd=password,
                   db=database,
                   host=host,
                   port=port)
+    if compress:
+        params["compress"] = True
+    if net_timeout is not None:
+        params["init_command"] = ("SET SESSION net_read_timeout=%d, net_write_timeout=%d"
+                                  % (net_timeout, net_timeout))
     default_params = dict(charset="utf8mb4", use_unicode="True")
     for k, v in default_params.items():
         params[k] = kwargs.pop(k, v)
     params.update(kwargs)
-    engine = _Engine(lambda: pymysql.connect(**params))
+    pool = _ConnectionPool(lambda: connect(**params), pool_min, pool_max, ping_threshold)
+    engine = _Engine(pool, cursors, batch, batch_window_ms)
+
+
+def _load_driver(driver):
+    """return the connect function and cursors module of a driver.
+
+    mysqlclient takes the same connect params as pymysql, so only the
+    module differs.
+    """
+    if driver == "pymysql":
+        return pymysql.connect, pymysql.cursors
+    if driver == "mysqlclient":
+        try:
+            import MySQLdb
+            import MySQLdb.cursors
+        except ImportError:
+            raise DBError("Driver 'mysqlclient' needs the mysqlclient package")
+        return MySQLdb.connect, MySQLdb.cursors
+    raise DBError("Unsupported driver: %s" % driver)
 
 
 class _Engine(object):
-    def __init__(self, connect):
-        self._connect = connect
+    def __init__(self, pool, cursors=pymysql.cursors, batch=False, batch_window_ms=5):
+        self.pool = pool
+        self.cursors = cursors
+        self.batch = batch
+        self.batch_window = batch_window_ms / 1000.0
 
     def connect(self):
-        return self._connect()
+        return self.pool.get_conn()
 
+    def release(self, conn):
+        self.pool.release(conn)
 
-class _Dbctx(threading.local):
-    def __init__(self):
-        self.connection = None
-        self.transactions = 0
 
-    def is_init(self):
-        return not (self.connection is None)
+class _ConnectionPool(object):
+    """a bounded pool of live connections.
+
+    at most ``max_size`` connections are open at the same time, ``get_conn``
+    blocks when all of them are in use. released connections are kept for
+    reuse, idle connections beyond ``min_size`` are closed. a reused connection
+    is only pinged when it sat idle longer than ``ping_threshold`` seconds,
+    so busy connections don't pay an extra round trip.
+    """
+
+    def __init__(self, connect, min_size=5, max_size=32, ping_threshold=30):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise DBError("Invalid pool size: min=%s, max=%s" % (min_size, max_size))
+        self._connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.ping_threshold = ping_threshold
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_size)
+
+    def get_conn(self):
+        self._slots.acquire()
+        try:
+            try:
+                conn, last_used = self._idle.get_nowait()
+            except queue.Empty:
+                return self._connect()
+            if time.monotonic() - last_used > self.ping_threshold:
+                try:
+                    conn.ping()
+                except Exception:
+                    self._close(conn)
+                    return self._connect()
+            return conn
+        except:
+            self._slots.release()
+            raise
+
+    def release(self, conn):
+        try:
+            # drop any snapshot/uncommitted state before the next borrower
+            conn.rollback()
+        except Exception:
+            self._close(conn)
+        else:
+            with self._lock:
+                keep = self._idle.qsize() < self.min_size
+                if keep:
+                    self._idle.put((conn, time.monotonic()))
+            if not keep:
+                self._close(conn)
+        finally:
+            self._slots.release()
 
-    def init(self):
+    def _close(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
+class _DbState(object):
+    """connection state of one ``connection()`` block."""
+    __slots__ = ('connection', 'transactions', 'pending_since', 'written')
+
+    def __init__(self):
         self.connection = _LazyConnection()
         self.transactions = 0
+        # time of the first write whose commit batch mode deferred
+        self.pending_since = None
+        # sql of the writes not committed yet, their cached reads go on commit
+        self.written = set()
+
+    def commit(self):
+        self.connection.commit()
+        if self.written:
+            written, self.written = self.written, set()
+            _result_cache.invalidate_written(written)
+
+    def rollback(self):
+        self.written.clear()
+        self.connection.rollback()
+
+    def defer_commit(self):
+        if self.pending_since is None:
+            self.pending_since = time.monotonic()
+        else:
+            self.flush_expired()
+
+    def flush_expired(self):
+        if self.pending_since is not None and time.monotonic() - self.pending_since >= engine.batch_window:
+            self.flush()
+
+    def flush(self):
+        if self.pending_since is not None:
+            self.pending_since = None
+            self.commit()
 
     def cleanup(self):
         self.connection.cleanup()
         self.connection = None
 
-    def cursor(self):
-        return self.connection.cursor()
+
+# set while a connection block is open. asyncio tasks copy the context on
+# creation, so a task created inside a block shares that block's connection
+# while it is open, and gets its own once the block has closed it.
+_db_ctx_var = contextvars.ContextVar('_db_ctx', default=None)
 
 
-_db_ctx = _Dbctx()
+def _open_ctx():
+    """open a connection state if the current context has none or only a closed one.
+
+    :return: the token to reset on exit, None when a state was already open
+    """
+    ctx = _db_ctx_var.get()
+    if ctx is None or ctx.connection is None:
+        return _db_ctx_var.set(_DbState())
+    return None
+
+
+def _close_ctx(token):
+    ctx = _db_ctx_var.get()
+    try:
+        try:
+            ctx.flush()
+        finally:
+            ctx.cleanup()
+    finally:
+        _db_ctx_var.reset(token)
 
 
 class _LazyConnection(object):
@@ -79,40 +262,39 @@ class _LazyConnection(object):
     def __init__(self):
         self.connection = None
 
-    def cursor(self):
+    def cursor(self, cursor_class=None):
         if self.connection is None:
             _connection = engine.connect()
-            logging.info('Connection OPEN is <%s>' % hex(id(_connection)))
+            if _logger.isEnabledFor(logging.INFO):
+                _logger.info('Connection OPEN is <%#x>', id(_connection))
             self.connection = _connection
-        return self.connection.cursor()
+        return self.connection.cursor(cursor_class)
 
     def commit(self):
-        return self.connection.commit()
+        if self.connection is not None:
+            self.connection.commit()
 
     def rollback(self):
-        return self.connection.rollback()
+        if self.connection is not None:
+            self.connection.rollback()
 
     def cleanup(self):
         if self.connection:
             _connection = self.connection
             self.connection = None
-            logging.info("Connection CLOSE is <%s>" % hex(id(_connection)))
-            _connection.close()
+            if _logger.isEnabledFor(logging.INFO):
+                _logger.info("Connection CLOSE is <%#x>", id(_connection))
+            engine.release(_connection)
 
 
 class _ConnectionCtx(object):
     def __enter__(self):
-        global _db_ctx
-        self.should_cleanup = False
-        if not _db_ctx.is_init():
-            _db_ctx.init()
-            self.should_cleanup = True
+        self.token = _open_ctx()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        global _db_ctx
-        if self.should_cleanup:
-            _db_ctx.cleanup()
+        if self.token is not None:
+            _close_ctx(self.token)
 
 
 def connection():
@@ -123,65 +305,75 @@ def _profiling(start, sql=''):
     """
     用于剖析sql的执行时间
     """
-    t = time.time() - start
+    t = time.perf_counter() - start
     if t > 0.1:
-        logging.warning('[PROFILING] [DB] %s: %s' % (t, sql))
-    else:
-        logging.info('[PROFILING] [DB] %s: %s' % (t, sql))
+        _logger.warning('[PROFILING] [DB] %s: %s', t, sql)
+    elif _logger.isEnabledFor(logging.INFO):
+        _logger.info('[PROFILING] [DB] %s: %s', t, sql)
+
+
+def _wraps(wrapper, func):
+    wrapper.__wrapped__ = func
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    return wrapper
 
 
 def with_connection(func):
-    @functools.wraps(func)
     def _wrapper(*args, **kwargs):
-        with _ConnectionCtx():
+        token = _open_ctx()
+        try:
             return func(*args, **kwargs)
-    return _wrapper
+        finally:
+            if token is not None:
+                _close_ctx(token)
+    return _wraps(_wrapper, func)
 
 
 def with_transaction(func):
-    @functools.wraps(func)
     def _wrapper(*args, **kwargs):
-        start = time.time()
-        with _Transactions():
-            return func(*args, **kwargs)
-        _profiling(start)
-    return _wrapper
+        start = time.perf_counter()
+        try:
+            token = _begin_transaction()
+            ok = False
+            try:
+                result = func(*args, **kwargs)
+                ok = True
+            finally:
+                _end_transaction(token, ok)
+            return result
+        finally:
+            _profiling(start, func.__name__)
+    return _wraps(_wrapper, func)
 
 
-class _Transactions(object):
-    def __enter__(self):
-        global _db_ctx
-        self.should_close_conn = False
-        if not _db_ctx.is_init():
-            _db_ctx.init()
-            self.should_close_conn = True
-        _db_ctx.transactions = _db_ctx.transactions + 1
-        return self
+def _begin_transaction():
+    token = _open_ctx()
+    ctx = _db_ctx_var.get()
+    if not ctx.transactions:
+        # a rollback must not take the deferred batch writes with it
+        ctx.flush()
+    ctx.transactions += 1
+    return token
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        global _db_ctx
-        _db_ctx.transactions = _db_ctx.transactions - 1
-        try:
-            if _db_ctx.transactions == 0:
-                if exc_type is None:
-                    self.commit()
-                else:
-                    self.rollback()
-
-        finally:
-            if self.should_close_conn:
-                _db_ctx.cleanup()
 
-    def commit(self):
-        global _db_ctx
-        try:
-            _db_ctx.connection.commit()
-        except:
-            _db_ctx.connection.rollback()
+def _end_transaction(token, ok):
+    """leave a transaction level, the outermost one commits or rolls back."""
+    ctx = _db_ctx_var.get()
+    ctx.transactions -= 1
+    try:
+        if ctx.transactions == 0:
+            if ok:
+                try:
+                    ctx.commit()
+                except:
+                    ctx.rollback()
+            else:
+                ctx.rollback()
 
-    def rollback(self):
-        global _db_ctx
-        _db_ctx.connection.rollback()
+    finally:
+        if token is not None:
+            _close_ctx(token)
 
 
 class DBError(Exception):
@@ -192,10 +384,8 @@ class Field(dict):
     """Implement a simple dictionary that can be accessed through properties.
     like: x.key = value
     """
-    def __init__(self, keys=set(), values=set(), **kwargs):
-        super(Field, self).__init__(**kwargs)
-        for k, v in zip(keys, values):
-            self[k] = v
+    def __init__(self, keys=(), values=(), **kwargs):
+        super(Field, self).__init__(zip(keys, values), **kwargs)
 
     def __getattr__(self, item):
         try:
@@ -207,27 +397,153 @@ class Field(dict):
         self[key] = value
 
 
-@with_connection
-def _select(sql, one, *args, **kwargs):
-    global _db_ctx
-    cursor = None
-    sql = sql.replace('?', '%s')
-    logging.info("SQL: %s, args: %s", sql, args)
+class Row(object):
+    """base class of the compact rows returned with ``slots=True``.
+
+    every column list gets its own subclass with one slot per column, so
+    values are plain attributes: row.username
+    """
+    __slots__ = ()
+    _fields = ()
+
+    def to_dict(self):
+        return Field(keys=self._fields, values=self._values())
+
+    def _values(self):
+        return tuple(getattr(self, name) for name in self._fields)
+
+    def __eq__(self, other):
+        if not isinstance(other, Row):
+            return NotImplemented
+        return self._fields == other._fields and self._values() == other._values()
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'Row(%s)' % ', '.join('%s=%r' % item for item in zip(self._fields, self._values()))
+
+    def __reduce__(self):
+        return _make_row, (self._fields, self._values())
+
+
+def _is_slot_name(name):
+    return (name.isidentifier() and not keyword.iskeyword(name)
+            and not name.startswith('_') and not hasattr(Row, name))
+
+
+@functools.lru_cache(maxsize=256)
+def _make_row_cls(names):
+    """build the Row subclass for a column list, None if a name can't be a slot."""
+    if len(set(names)) != len(names) or not all(_is_slot_name(name) for name in names):
+        return None
+    source = ['def __init__(self, values):']
+    source.extend('    self.%s = values[%d]' % (name, i) for i, name in enumerate(names))
+    if not names:
+        source.append('    pass')
+    namespace = {}
+    exec('\n'.join(source), namespace)
+    return type('Row', (Row,), {'__slots__': names,
+                                '_fields': names,
+                                '__init__': namespace['__init__']})
+
+
+def _make_row(names, values):
+    return _make_row_cls(names)(values)
 
+
+def _row_factory(names, slots=False):
+    """return a callable that turns a values tuple into a row object, names is a tuple."""
+    if slots:
+        row_cls = _make_row_cls(names)
+        if row_cls is not None:
+            return row_cls
+    return functools.partial(Field, names)
+
+
+@functools.lru_cache(maxsize=1024)
+def _translate(sql):
+    """rewrite the ``?`` placeholders to the driver's ``%s`` style."""
+    return sql.replace('?', '%s')
+
+
+def _execute(sql, args, cursor_class=None):
+    """run a query on the current connection and return the open cursor."""
+    sql = _translate(sql)
+    if _logger.isEnabledFor(logging.INFO):
+        _logger.info("SQL: %s, args: %s", sql, args)
+
+    ctx = _db_ctx_var.get()
+    if ctx.pending_since is not None:
+        ctx.flush_expired()
+    cursor = ctx.connection.cursor(cursor_class)
     try:
-        cursor = _db_ctx.connection.cursor()
         cursor.execute(sql, args)
-        if cursor.description:
-            names = [field[0] for field in cursor.description]
+    except:
+        cursor.close()
+        raise
+    return cursor
+
+
+@with_connection
+def _select(sql, one, *args, **kwargs):
+    cursor = _execute(sql, args)
+    try:
+        if not cursor.description:
+            return None if one else []
+        names = tuple(field[0] for field in cursor.description)
+        make_row = _row_factory(names, kwargs.get('slots', False))
         if one:
             values = cursor.fetchone()
             if not values:
                 return None
-            return Field(keys=names, values=values)
-        return [Field(keys=names, values=values) for values in cursor.fetchall()]
+            return make_row(values)
+        return [make_row(values) for values in cursor.fetchall()]
     finally:
-        if cursor:
+        cursor.close()
+
+
+@with_connection
+def _select_plain(sql, one, args, cursor_class=None):
+    """return the driver rows as they are, without wrapping them."""
+    cursor = _execute(sql, args, cursor_class)
+    try:
+        if one:
+            return cursor.fetchone()
+        return list(cursor.fetchall())
+    finally:
+        cursor.close()
+
+
+def _iter_select(sql, args, fetch_size, slots=False):
+    """stream rows with a server side cursor, fetch_size rows at a time.
+
+    the stream borrows its own pooled connection and keeps it out of the
+    context, queries made while iterating use the caller's connection.
+    """
+    sql = _translate(sql)
+    if _logger.isEnabledFor(logging.INFO):
+        _logger.info("SQL: %s, args: %s", sql, args)
+
+    conn = engine.connect()
+    try:
+        cursor = conn.cursor(engine.cursors.SSCursor)
+        try:
+            cursor.execute(sql, args)
+            if not cursor.description:
+                return
+            cursor.arraysize = min(fetch_size, MAX_BULK_FETCH_ROW_COUNT)
+            names = tuple(field[0] for field in cursor.description)
+            make_row = _row_factory(names, slots)
+            while True:
+                rows = cursor.fetchmany(cursor.arraysize)
+                if not rows:
+                    break
+                for values in rows:
+                    yield make_row(values)
+        finally:
             cursor.close()
+    finally:
+        engine.release(conn)
 
 
 def select_one(sql, *args, **kwargs):
@@ -248,25 +564,224 @@ def select(sql, *args, **kwargs):
     1
     >>> select_sql[0].username
     guoweikuang
+
+    pass ``stream=True`` to get a generator backed by a server side cursor,
+    rows are fetched ``fetch_size`` at a time so memory stays bounded. the
+    stream reads on its own pooled connection, held until the generator is
+    exhausted or closed, so it doesn't see the caller's uncommitted writes.
+
+    >>> for user in select('select * from users', stream=True):
+    ...     print(user.username)
+
+    pass ``slots=True`` to get compact ``Row`` objects instead of ``Field``
+    dicts, they are cheaper to build and ``row.to_dict()`` gives a ``Field``.
+    results whose column names can't be attributes still come back as ``Field``.
     """
+    stream = kwargs.pop('stream', False)
+    fetch_size = kwargs.pop('fetch_size', DEFAULT_BULK_FETCH_ROW_COUNT)
+    if stream:
+        if fetch_size < 1:
+            raise DBError("fetch_size must be at least 1, got %s" % fetch_size)
+        return _iter_select(sql, args, fetch_size, kwargs.get('slots', False))
     return _select(sql, False, *args, **kwargs)
 
 
+def select_raw(sql, *args, **kwargs):
+    """execute sql and return the driver's value tuples, no row objects are built.
+    pass ``one=True`` to get a single tuple or None.
+
+    >>> select_raw('select id, username from users where id=?', 1)
+    [(1, 'guoweikuang')]
+    """
+    return _select_plain(sql, kwargs.get('one', False), args)
+
+
+def select_dict(sql, *args, **kwargs):
+    """execute sql and return plain dicts built by the driver's DictCursor.
+    pass ``one=True`` to get a single dict or None.
+
+    >>> select_dict('select id, username from users where id=?', 1)
+    [{'id': 1, 'username': 'guoweikuang'}]
+    """
+    return _select_plain(sql, kwargs.get('one', False), args, engine.cursors.DictCursor)
+
+
+_WRITE_TABLE_RE = re.compile(r'^\s*(insert|replace|update|delete)'
+                             r'(?:\s+(?:low_priority|delayed|high_priority|ignore|quick))*'
+                             r'(?:\s+(?:into|from))?'
+                             r'\s+(?:`?\w+`?\.)?`?(\w+)`?\s*(.*)$',
+                             re.IGNORECASE | re.DOTALL)
+# what may follow the table name, anything else (a comma, join, ...) may touch more tables
+_WRITE_TAIL_RE = {
+    'insert': re.compile(r'(?:\(|(?:values?|set|select)\b)', re.IGNORECASE),
+    'replace': re.compile(r'(?:\(|(?:values?|set|select)\b)', re.IGNORECASE),
+    'update': re.compile(r'(?:(?:as\s+)?`?\w+`?\s+)?set\b', re.IGNORECASE),
+    'delete': re.compile(r'(?:(?:where|order|limit)\b|$)', re.IGNORECASE),
+}
+
+
+def _written_table(sql):
+    """return the one table a write statement touches, None when it can't be told."""
+    match = _WRITE_TABLE_RE.match(sql)
+    if match is None:
+        return None
+    verb, table, tail = match.groups()
+    if not _WRITE_TAIL_RE[verb.lower()].match(tail):
+        return None
+    return table
+
+
+class _ResultCache(object):
+    """a thread safe LRU cache of select results, every entry has its own ttl."""
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+        # bumped by every invalidation
+        self.generation = 0
+        # select_cached reads in flight, and the invalidations made meanwhile
+        # as (generation, pattern or None for all), so a read isn't stored
+        # when one that matches its sql happened after it started
+        self._readers = 0
+        self._recent = []
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        """return (hit, rows)."""
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return False, None
+            expires, rows = item
+            if expires < time.monotonic():
+                del self._data[key]
+                return False, None
+            self._data.move_to_end(key)
+            return True, rows
+
+    def begin_read(self):
+        """return the generation a read of the database starts at."""
+        with self._lock:
+            self._readers += 1
+            return self.generation
+
+    def end_read(self, generation, key, rows, ttl):
+        """store the rows of a read unless a matching invalidation ran during it, rows None stores nothing."""
+        with self._lock:
+            self._readers -= 1
+            stale = any(gen > generation and (pattern is None or pattern.search(key[0]))
+                        for gen, pattern in self._recent)
+            if not self._readers:
+                self._recent = []
+            if rows is None or stale:
+                return
+            self._data[key] = (time.monotonic() + ttl, rows)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def _idle(self):
+        return not self._data and not self._readers
+
+    def invalidate(self, sql_pattern=None):
+        with self._lock:
+            self.generation += 1
+            if self._idle():
+                return
+            pattern = None if sql_pattern is None else re.compile(sql_pattern, re.IGNORECASE)
+            if self._readers:
+                self._recent.append((self.generation, pattern))
+            if pattern is None:
+                self._data.clear()
+                return
+            for key in [key for key in self._data if pattern.search(key[0])]:
+                del self._data[key]
+
+    def invalidate_written(self, sqls):
+        """drop the entries that read the tables committed write statements touched."""
+        with self._lock:
+            if self._idle():
+                self.generation += 1
+                return
+        tables = set()
+        for sql in sqls:
+            table = _written_table(sql)
+            if table is None:
+                self.invalidate()
+                return
+            tables.add(re.escape(table))
+        self.invalidate(r'\b(?:%s)\b' % '|'.join(sorted(tables)))
+
+
+_result_cache = _ResultCache()
+
+
+def select_cached(sql, *args, **kwargs):
+    """like select, but serve repeated (sql, args) from an in-process cache.
+
+    >>> users = select_cached('select * from users where id=?', 1, ttl=30)
+
+    entries live ``ttl`` seconds (default 60). writes through this module
+    drop the entries whose sql mentions the written table once they commit,
+    writes from elsewhere are only seen after the ttl. inside a transaction
+    or with deferred batch writes the cache is bypassed. the cached rows are
+    shared between callers, treat them as read only.
+    """
+    ttl = kwargs.pop('ttl', 60)
+    ctx = _db_ctx_var.get()
+    if ctx is not None and (ctx.transactions or ctx.pending_since is not None):
+        # uncommitted writes may be visible on this connection
+        return select(sql, *args, **kwargs)
+    try:
+        key = (sql, args, bool(kwargs.get('slots', False)))
+        hit, rows = _result_cache.get(key)
+    except TypeError:
+        # unhashable args, e.g. a list for an in clause
+        return select(sql, *args, **kwargs)
+    if hit:
+        return list(rows)
+    generation = _result_cache.begin_read()
+    rows = None
+    try:
+        rows = _select(sql, False, *args, **kwargs)
+    finally:
+        _result_cache.end_read(generation, key, rows, ttl)
+    return list(rows)
+
+
+def invalidate(sql_pattern=None):
+    """drop cached select results, all of them or those whose sql matches the regex."""
+    _result_cache.invalidate(sql_pattern)
+
+
+def _finish_write(ctx, sql):
+    """auto commit a write made outside a transaction, its cached reads go on commit."""
+    ctx.written.add(sql)
+    if not ctx.transactions:
+        if engine.batch:
+            ctx.defer_commit()
+        else:
+            _logger.info("auto commit")
+            ctx.commit()
+
+
 @with_connection
 def _update(sql, *args, **kwargs):
-    """update data."""
-    global _db_ctx
+    """update data, sql must already use ``%s`` placeholders."""
     cursor = None
-    sql = sql.replace('?', '%s')
-    logging.info('SQL: %s, args: %s', sql, args)
+    if _logger.isEnabledFor(logging.INFO):
+        _logger.info('SQL: %s, args: %s', sql, args)
 
+    ctx = _db_ctx_var.get()
+    conn = ctx.connection
     try:
-        cursor = _db_ctx.connection.cursor()
+        cursor = conn.cursor()
         cursor.execute(sql, args)
         row_count = cursor.rowcount
-        if not _db_ctx.transactions:
-            logging.info("auto commit")
-            _db_ctx.connection.commit()
+        _finish_write(ctx, sql)
         return row_count
     finally:
         if cursor:
@@ -281,7 +796,13 @@ def update(sql, *args, **kwargs):
     :param kwargs:
     :return:
     """
-    return _update(sql, *args, **kwargs)
+    return _update(_translate(sql), *args, **kwargs)
+
+
+@functools.lru_cache(maxsize=512)
+def _insert_sql(table_name, cols):
+    return "insert into `%s` (%s) values(%s)" % (table_name, ','.join(['`%s`' % col for col in cols]),
+                                                 ','.join(['%s'] * len(cols)))
 
 
 def insert(table_name, **kwargs):
@@ -292,10 +813,202 @@ def insert(table_name, **kwargs):
     :param kwargs:
     :return:
     """
-    cols, args = zip(*kwargs.items())
-    sql = "insert into `%s` (%s) values(%s)" % (table_name, ','.join(['`%s`' % col for col in cols]),
-          ','.join(['?' for _ in range(len(cols))]))
-    return _update(sql, *args)
+    cols = tuple(sorted(kwargs))
+    return _update(_insert_sql(table_name, cols), *[kwargs[col] for col in cols])
+
+
+def flush():
+    """commit the writes batch mode deferred on the current connection."""
+    ctx = _db_ctx_var.get()
+    if ctx is not None:
+        ctx.flush()
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+@with_connection
+def _update_many(sql, seq_of_args):
+    """execute the same sql for every args in one executemany call, sql must use ``%s``."""
+    cursor = None
+    if _logger.isEnabledFor(logging.INFO):
+        _logger.info('SQL: %s, rows: %s', sql, len(seq_of_args))
+
+    ctx = _db_ctx_var.get()
+    conn = ctx.connection
+    try:
+        cursor = conn.cursor()
+        cursor.executemany(sql, seq_of_args)
+        row_count = cursor.rowcount
+        _finish_write(ctx, sql)
+        return row_count
+    finally:
+        if cursor:
+            cursor.close()
+
+
+def insert_many(table_name, rows):
+    """insert many rows with multi-row insert statements in one transaction.
+
+    >>> insert_many('users', [dict(username='guo'), dict(username='kuang')])
+    2
+
+    :param table_name: table name
+    :param rows: list of dict, every dict must have the same keys
+    :return: affected row count
+    """
+    rows = list(rows)
+    if not rows:
+        return 0
+    cols = list(rows[0].keys())
+    col_set = set(cols)
+    for row in rows:
+        if set(row) != col_set:
+            raise DBError("Rows have different columns: %s, %s" % (sorted(col_set), sorted(row)))
+    return _insert_many(table_name, rows, cols)
+
+
+@with_transaction
+def _insert_many(table_name, rows, cols):
+    col_sql = ','.join(['`%s`' % col for col in cols])
+    values_sql = '(%s)' % ','.join(['%s'] * len(cols))
+    row_count = 0
+    for chunk in _chunks(rows, BULK_CHUNK_SIZE):
+        sql = "insert into `%s` (%s) values%s" % (table_name, col_sql, ','.join([values_sql] * len(chunk)))
+        args = [row[col] for row in chunk for col in cols]
+        row_count += _update(sql, *args)
+    return row_count
+
+
+def update_many(sql, seq_of_args):
+    """execute sql for every args in seq_of_args in one transaction.
+
+    >>> update_many('update users set username=? where id=?', [('guo', 1), ('kuang', 2)])
+    2
+
+    :param sql:
+    :param seq_of_args: sequence of args tuple
+    :return: affected row count
+    """
+    chunks = _chunks(seq_of_args, BULK_CHUNK_SIZE)
+    first = next(chunks, None)
+    if first is None:
+        return 0
+    return _update_chunks(_translate(sql), itertools.chain([first], chunks))
+
+
+@with_transaction
+def _update_chunks(sql, chunks):
+    row_count = 0
+    for chunk in chunks:
+        row_count += _update_many(sql, chunk)
+    return row_count
+
+
+class _LoadHandle(object):
+    """result handle returned by ``KeyLoader.load``."""
+
+    def __init__(self, loader):
+        self._loader = loader
+        self._event = threading.Event()
+        self._result = None
+        self._error = None
+
+    def done(self):
+        return self._event.is_set()
+
+    def get(self):
+        """return the row for the key, or None if there isn't one."""
+        if not self._event.is_set():
+            self._loader.flush()
+            self._event.wait()
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def _resolve(self, result=None, error=None):
+        self._result = result
+        self._error = error
+        self._event.set()
+
+
+class KeyLoader(object):
+    """coalesce lookups by key into one ``where key in (...)`` query.
+
+    >>> users = KeyLoader('users', 'id')
+    >>> first, second = users.load(1), users.load(2)
+    >>> first.get().username
+    guoweikuang
+
+    pending keys are loaded together when a handle's ``get`` is called, on
+    ``flush``, or ``window_ms`` after the first pending key when it is set.
+    the timer flushes from its own thread and connection, so leave it unset
+    to read inside the caller's transaction. results are not cached.
+
+    keys must compare equal to the values the database returns, a key of
+    another type ('2' for an int column) or another case under a case
+    insensitive collation raises DBError instead of loading None.
+    """
+
+    def __init__(self, table, key_col, cols='*', window_ms=None):
+        self.table = table
+        self.key_col = key_col
+        self.cols = cols
+        self.window_ms = window_ms
+        self._pending = {}
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def load(self, key):
+        with self._lock:
+            handle = self._pending.get(key)
+            if handle is None:
+                handle = self._pending[key] = _LoadHandle(self)
+                if self.window_ms is not None and self._timer is None:
+                    self._timer = threading.Timer(self.window_ms / 1000.0, self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+        return handle
+
+    def load_many(self, keys):
+        return [self.load(key) for key in keys]
+
+    def flush(self):
+        """load every pending key."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            timer, self._timer = self._timer, None
+        if timer is not None:
+            timer.cancel()
+        if not pending:
+            return
+
+        cols = self.cols
+        if cols != '*':
+            cols = '`%s`, %s' % (self.key_col, cols)
+        rows = {}
+        try:
+            for keys in _chunks(pending, BULK_CHUNK_SIZE):
+                sql = "select %s from `%s` where `%s` in (%s)" % (cols, self.table, self.key_col,
+                                                                  ','.join(['?'] * len(keys)))
+                for row in select(sql, *keys):
+                    key = row[self.key_col]
+                    if key not in pending:
+                        raise DBError("Key %r of table %s matches no loaded key, load keys of the column's type"
+                                      % (key, self.table))
+                    rows[key] = row
+        except Exception as e:
+            for handle in pending.values():
+                handle._resolve(error=e)
+            raise
+        for key, handle in pending.items():
+            handle._resolve(rows.get(key))
 
 
 if __name__ == "__main__":
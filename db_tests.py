@@ -5,8 +5,10 @@ db unit tests module
 
 @author guoweikuang
 """
+import pickle
 import unittest
 import threading
+import contextvars
 
 import db
 from db import create_engine, connection
@@ -29,16 +31,247 @@ class DBTestCase(unittest.TestCase):
     def test_thread_engine_is_different(self):
         pass
 
+    def test_connection_state_is_isolated(self):
+        seen, nested, closed = [], [], []
+
+        def open_connection():
+            with connection():
+                state = db._db_ctx_var.get()
+                with connection():
+                    nested.append(db._db_ctx_var.get() is state)
+                seen.append(state)
+            closed.append(db._db_ctx_var.get())
+
+        contextvars.copy_context().run(open_connection)
+        contextvars.copy_context().run(open_connection)
+        thread = threading.Thread(target=open_connection)
+        thread.start()
+        thread.join()
+        self.assertEqual(len(seen), 3)
+        self.assertEqual(len(set(map(id, seen))), 3)
+        self.assertEqual(nested, [True] * 3)
+        self.assertEqual(closed, [None] * 3)
+        self.assertTrue(db._db_ctx_var.get() is None)
+
+    def test_closed_inherited_state_is_replaced(self):
+        with connection():
+            outer = db._db_ctx_var.get()
+            inherited = contextvars.copy_context()
+
+        def open_connection():
+            with connection():
+                return db._db_ctx_var.get()
+
+        state = inherited.run(open_connection)
+        self.assertTrue(state is not outer)
+        self.assertTrue(outer.connection is None)
+        self.assertTrue(inherited.run(db._db_ctx_var.get) is outer)
+
+    def test_pool_size_is_checked(self):
+        db.engine = None
+        with self.assertRaises(db.DBError):
+            create_engine(username='root',
+                          password='2014081029',
+                          database='test',
+                          host='localhost',
+                          port=3306,
+                          pool_min=10,
+                          pool_max=2)
+
+    def test_unknown_driver(self):
+        db.engine = None
+        with self.assertRaises(db.DBError):
+            create_engine(username='root',
+                          password='2014081029',
+                          database='test',
+                          host='localhost',
+                          port=3306,
+                          driver='sqlite')
+
+    def test_pymysql_has_no_compress(self):
+        db.engine = None
+        with self.assertRaises(db.DBError):
+            create_engine(username='root',
+                          password='2014081029',
+                          database='test',
+                          host='localhost',
+                          port=3306,
+                          compress=True)
+
+    def test_field(self):
+        field = db.Field(('id', 'username'), (2, 'kuang'))
+        self.assertEqual(field.username, 'kuang')
+        self.assertEqual(db.Field(id=2), {'id': 2})
+        self.assertEqual(db.Field(), {})
+
+    def test_row_class(self):
+        row_cls = db._make_row_cls(('id', 'username'))
+        self.assertTrue(row_cls is db._make_row_cls(('id', 'username')))
+        row = row_cls((2, 'kuang'))
+        self.assertEqual(row.username, 'kuang')
+        self.assertEqual(row.to_dict(), {'id': 2, 'username': 'kuang'})
+        self.assertEqual(pickle.loads(pickle.dumps(row)), row)
+        self.assertTrue(db._make_row_cls(('count(*)',)) is None)
+
+    def test_insert_sql(self):
+        sql = db._insert_sql('users', ('id', 'username'))
+        self.assertEqual(sql, "insert into `users` (`id`,`username`) values(%s,%s)")
+
+    def test_written_table(self):
+        for sql in ("update users set username=%s where id=%s",
+                    "update ignore users set username=%s",
+                    "update low_priority `users` u set u.username=%s",
+                    "update test.users set username=%s",
+                    "insert into `users` (`username`) values(%s)",
+                    "insert low_priority ignore into test.`users` values(%s)",
+                    "replace into users set username=%s",
+                    "delete quick from users where id=%s",
+                    "delete from users"):
+            self.assertEqual(db._written_table(sql), 'users', sql)
+        for sql in ("update users, orders set users.username=%s",
+                    "update users join orders on users.id=orders.uid set username=%s",
+                    "delete users from users join orders on users.id=orders.uid",
+                    "delete from users using users, orders",
+                    "truncate users"):
+            self.assertTrue(db._written_table(sql) is None, sql)
+
+    def test_result_cache_generations(self):
+        cache = db._ResultCache()
+        users, orders = ('select * from users', (), False), ('select * from orders', (), False)
+        cache.invalidate_written(["update users set username=%s"])
+        self.assertEqual(cache._recent, [])
+
+        generation = cache.begin_read()
+        other = cache.begin_read()
+        cache.invalidate_written(["update orders set uid=%s"])
+        cache.end_read(generation, users, ['kuang'], 60)
+        self.assertEqual(cache.get(users), (True, ['kuang']))
+        cache.invalidate_written(["update users set username=%s"])
+        cache.end_read(other, orders, ['order'], 60)
+        self.assertEqual(cache.get(orders), (False, None))
+        self.assertEqual(cache.get(users), (False, None))
+        self.assertEqual(cache._recent, [])
+
     def test_select(self):
         with connection():
             select_obj = db.select("select * from users where id=?", 2)
             self.assertTrue(select_obj[0].username == 'kuang')
 
+    def test_select_stream_fetch_size(self):
+        with self.assertRaises(db.DBError):
+            db.select("select * from users", stream=True, fetch_size=0)
+
+    def test_select_stream(self):
+        with connection():
+            users = db.select("select * from users where id=?", 2, stream=True)
+            self.assertTrue([user.username for user in users] == ['kuang'])
+
+    def test_select_stream_with_queries_inside(self):
+        with connection():
+            users = db.select("select * from users where id in (?, ?)", 1, 2, stream=True, fetch_size=1)
+            names = []
+            for user in users:
+                names.append(user.username)
+                self.assertTrue(db.select_one("select * from users where id=?", 2).username == 'kuang')
+            self.assertTrue(len(names) == 2)
+
+    def test_select_raw_and_dict(self):
+        with connection():
+            sql = "select id, username from users where id=?"
+            self.assertTrue(db.select_raw(sql, 2) == [(2, 'kuang')])
+            self.assertTrue(db.select_dict(sql, 2, one=True) == {'id': 2, 'username': 'kuang'})
+
+    def test_select_cached(self):
+        with connection():
+            sql = "select * from users where id=?"
+            self.assertTrue(db.select_cached(sql, 2)[0].username == 'kuang')
+            self.assertTrue(db.select_cached(sql, 2) == db.select(sql, 2))
+            db.update("update users set username=? where id=?", 'kuang', 2)
+            self.assertTrue(len(db._result_cache) == 0)
+
+    def test_select_cached_after_rollback(self):
+        sql = "select * from users where id=?"
+
+        @db.with_transaction
+        def rename():
+            db.update("update users set username=? where id=?", 'rolled back', 2)
+            db.select_cached(sql, 2)
+            raise ValueError('rollback')
+
+        with self.assertRaises(ValueError):
+            rename()
+        self.assertTrue(len(db._result_cache) == 0)
+        self.assertTrue(db.select_cached(sql, 2)[0].username == 'kuang')
+
+    def test_batch_commit(self):
+        db.engine = None
+        create_engine(username='root',
+                      password='2014081029',
+                      database='test',
+                      host='localhost',
+                      port=3306,
+                      batch=True,
+                      batch_window_ms=60000)
+        sql = "update users set username=? where id=?"
+
+        @db.with_transaction
+        def fail():
+            raise ValueError('rollback')
+
+        with connection():
+            ctx = db._db_ctx_var.get()
+            db.update(sql, 'kuang', 2)
+            self.assertTrue(ctx.pending_since is not None)
+            db.select("select * from users where id=?", 2)
+            self.assertTrue(ctx.pending_since is not None)
+            db.flush()
+            self.assertTrue(ctx.pending_since is None)
+
+            db.update(sql, 'kuang', 2)
+            with self.assertRaises(ValueError):
+                fail()
+            self.assertTrue(ctx.pending_since is None)
+
+            db.engine.batch_window = 0
+            db.update(sql, 'kuang', 2)
+            db.select("select * from users where id=?", 2)
+            self.assertTrue(ctx.pending_since is None)
+
+    def test_key_loader(self):
+        with connection():
+            users = db.KeyLoader('users', 'id')
+            first, missing = users.load(2), users.load(-1)
+            self.assertFalse(first.done())
+            self.assertTrue(first.get().username == 'kuang')
+            self.assertTrue(missing.done() and missing.get() is None)
+
+    def test_key_loader_key_type(self):
+        with connection():
+            users = db.KeyLoader('users', 'id', cols='username')
+            self.assertTrue(users.load(2).get().username == 'kuang')
+            self.assertTrue(users.load(-1).get() is None)
+            mismatched = users.load('2')
+            with self.assertRaises(db.DBError):
+                mismatched.get()
+
     def test_insert(self):
         with connection():
             user = dict(username='guo')
             insert_obj = db.insert("users", **user)
             self.assertTrue(insert_obj == 1)
 
+    def test_insert_many(self):
+        with connection():
+            users = [dict(username='guo'), dict(username='wei')]
+            self.assertTrue(db.insert_many("users", users) == 2)
+
+    def test_insert_many_empty_and_mismatched(self):
+        self.assertEqual(db.insert_many("users", []), 0)
+        self.assertEqual(db.update_many("update users set username=? where id=?", []), 0)
+        with connection():
+            self.assertEqual(db.insert_many("users", []), 0)
+        with self.assertRaises(db.DBError):
+            db.insert_many("users", [dict(username='guo'), dict(username='wei', id=3)])
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file